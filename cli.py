@@ -34,13 +34,24 @@ from torrent import Torrent
 
 logging = init_logger(__name__, testing_mode=debug_logging_enabled)
 
+try:
+    # Optional, libuv based event loop with a faster socket I/O path
+    import uvloop
+
+    uvloop.install()
+except ImportError:
+    pass
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--file", help="Torrent's absolute file path", type=str, required=True)
+    parser.add_argument("--no-inmemory-buffer", dest="inmemory_buffer", action="store_false",
+                        help="Write blocks directly to the output file instead of buffering each piece "
+                             "in memory until it is verified (uses less memory, suited to SSDs)")
     args = parser.parse_args()
 
     loop = asyncio.get_event_loop()
-    client = TorrentClient(Torrent(torrent_path=args.file))
+    client = TorrentClient(Torrent(torrent_path=args.file), args.inmemory_buffer)
     task = asyncio.ensure_future(client.start())
 
 
@@ -50,7 +61,13 @@ if __name__ == "__main__":
         task.cancel()
 
 
-    signal.signal(signal.SIGINT, signal_handler)
+    try:
+        # Run the handler as a regular event loop callback instead of interrupting
+        # whatever the loop is executing
+        loop.add_signal_handler(signal.SIGINT, signal_handler)
+    except NotImplementedError:
+        # Event loops on Windows do not support signal handlers
+        signal.signal(signal.SIGINT, signal_handler)
 
     try:
         logging.info("Starting client task")
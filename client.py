@@ -25,13 +25,21 @@ SOFTWARE.
 """
 
 import asyncio
-import math
+import errno
+import heapq
+import mmap
 import os
+import sys
+import threading
 import time
-from collections import defaultdict
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import partial
 from hashlib import sha1
-from typing import List, Union
+from logging import DEBUG
+from typing import Dict, List, Set, Tuple, Union
 
 from logger import init_logger, debug_logging_enabled
 from protocol import PeerConnection, REQUEST_SIZE
@@ -39,8 +47,32 @@ from tracker import Tracker
 
 # Maximum number of workers who can connect to peers
 MAX_PEER_CONNECTIONS = 40
+# Maximum number of rarity heap entries inspected when looking for the rarest piece a
+# peer has, past it the pieces the peer has are searched directly
+RARITY_SCAN_LIMIT = 64
+# Maximum number of adjacent pieces written with a single pwritev call
+WRITE_RUN_LIMIT = 64
+# Expands each byte of a bitfield into 8 bytes, one per piece (1 if the peer has it)
+_BITFIELD_BYTES = [bytes((byte >> shift) & 1 for shift in range(7, -1, -1)) for byte in range(256)]
 logging = init_logger(__name__, testing_mode=debug_logging_enabled)
 
+if hasattr(os, 'pwrite'):
+    _pwrite = os.pwrite
+else:
+    def _pwrite(fd: int, data, pos: int) -> int:
+        """
+        Fallback for platforms without pwrite (Windows). Only the disk thread moves
+        the file offset, so seeking first is safe
+        """
+        os.lseek(fd, pos, os.SEEK_SET)
+        return os.write(fd, data)
+
+# Piece hashes are integrity checks, not security, so let OpenSSL skip its FIPS gating (Python 3.9+)
+if sys.version_info >= (3, 9):
+    _new_sha1 = partial(sha1, usedforsecurity=False)
+else:
+    _new_sha1 = sha1
+
 
 class TorrentClient:
     """
@@ -54,16 +86,19 @@ class TorrentClient:
     (maximum peer connections is defined by global MAX_PEER_CONNECTIONS variable).
     """
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, inmemory_buffer: bool = True):
         # Tracker object that defines methods to connect to the tracker
         self.tracker = Tracker(torrent)
-        self.piece_manager = PieceManager(torrent)
+        self.piece_manager = PieceManager(torrent, inmemory_buffer)
         # Queue of potential peers which the PeerConnection objects will consume
-        self.available_peers = asyncio.Queue()
+        self.available_peers = PeerQueue()
         # List of PeerConnection objects which might be connected to the peer.
         # Else it is waiting to consume a peer from the available_peers queue
         self.peers = []
         self.abort = False
+        # Set when the download completes or is stopped, wakes up the tracker loop
+        self._done = asyncio.Event()
+        self.piece_manager.on_complete = self._done.set
 
     async def start(self):
         """
@@ -86,59 +121,59 @@ class TorrentClient:
         # Default request interval (in sec) to tracker
         request_interval = 300  # sec
 
-        while True:
-            if self.abort:
-                logging.warning("Aborting download")
-                break
-
-            if self.piece_manager.complete:
-                logging.info("Download completed")
-                break
-
-            current_time = time.time()
-
-            # Check if request_interval time has passed so make announce call to tracker
-            if (not previous_request) or (previous_request + request_interval) < current_time:
-                tracker_response = await self.tracker.connect(
-                    first=previous_request if previous_request else False,
-                    uploaded=self.piece_manager.bytes_uploaded,
-                    downloaded=self.piece_manager.bytes_downloaded
-                )
-
-                if tracker_response:
-                    logging.debug("Got tracker response")
-                    previous_request = current_time
-                    request_interval = tracker_response.interval
-                    self._empty_queue()
-                    for peer in tracker_response.peers:
-                        if peer:
-                            self.available_peers.put_nowait(peer)
-            else:
-                logging.warning("Waiting for next tracker announce call, interval is {request_interval}".format(
-                    request_interval=request_interval))
-                for peer in self.peers:
-                    logging.debug("State of peer {id} is {status}".format(
-                        id=peer.remote_id,
-                        status=peer.my_state))
-                await asyncio.sleep(5)
-        self.stop()
+        try:
+            while True:
+                if self.abort:
+                    logging.warning("Aborting download")
+                    break
+
+                if self.piece_manager.complete:
+                    logging.info("Download completed")
+                    break
+
+                current_time = time.time()
+
+                # Check if request_interval time has passed so make announce call to tracker
+                if (not previous_request) or (previous_request + request_interval) < current_time:
+                    tracker_response = await self.tracker.connect(
+                        first=previous_request is None,
+                        uploaded=self.piece_manager.bytes_uploaded,
+                        downloaded=self.piece_manager.bytes_downloaded
+                    )
+
+                    if tracker_response:
+                        logging.debug("Got tracker response")
+                        previous_request = current_time
+                        request_interval = tracker_response.interval
+                        # Peers from the previous announce are replaced by the new ones
+                        self.available_peers.clear()
+                        self.available_peers.extend(peer for peer in tracker_response.peers if peer)
+                else:
+                    logging.warning("Waiting for next tracker announce call, interval is {request_interval}".format(
+                        request_interval=request_interval))
+                    if logging.isEnabledFor(DEBUG):
+                        for peer in self.peers:
+                            logging.debug("State of peer %s is %s", peer.remote_id, peer.my_state)
+                    # Sleep until the next announce is due, unless the download completes
+                    # or is stopped in the meantime
+                    delay = max(1, (previous_request + request_interval) - time.time())
+                    try:
+                        await asyncio.wait_for(self._done.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.stop()
+            await self.tracker.close()
 
     def stop(self):
         """
         Stop download and send stop signal to all peer objects
         """
         self.abort = True
+        self._done.set()
         for peer in self.peers:
             peer.stop()
         self.piece_manager.close()
-        self.tracker.close()
-
-    def _empty_queue(self):
-        """
-        Remove all peers from the queue
-        """
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
 
     def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
         """
@@ -150,12 +185,56 @@ class TorrentClient:
         :param data: Binary block data
         :return:
         """
-        self.piece_manager.block_received(
+        duplicates = self.piece_manager.block_received(
             peer_id=peer_id,
             piece_index=piece_index,
             block_offset=block_offset,
             data=data
         )
+        # Endgame: the other peers the block was requested from do not need to send it
+        if duplicates:
+            for peer in self.peers:
+                if peer.remote_id in duplicates:
+                    peer.cancel_request(piece_index, block_offset, len(data))
+
+
+class PeerQueue:
+    """
+    Queue of peers (ip, port) waiting to be consumed by the PeerConnection objects.
+
+    Peers are always added in bulk from a tracker response, so the queue is a plain
+    deque filled in one go and a single event waking up the waiting consumers.
+    """
+
+    def __init__(self):
+        self._peers = deque()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._peers)
+
+    def extend(self, peers) -> None:
+        """
+        Adds the peers to the queue and wakes up the waiting consumers
+        """
+        self._peers.extend(peers)
+        if self._peers:
+            self._ready.set()
+
+    def clear(self) -> None:
+        """
+        Remove all peers from the queue
+        """
+        self._peers.clear()
+
+    async def get(self):
+        """
+        Remove and return the first peer of the queue, waiting until one is available
+        """
+        while not self._peers:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._peers.popleft()
 
 
 class Block:
@@ -165,53 +244,101 @@ class Block:
 
     Block size if usually size of REQUEST_SIZE, except for the last block in a piece which maybe
     smaller than REQUEST_SIZE
+
+    The status of the blocks is kept by their Piece, Block objects are only created when
+    a block is handed out to be requested from a peer
     """
     Missing = 0
     Pending = 1
     Retrieved = 2
 
+    __slots__ = ('piece', 'offset', 'length')
+
     def __init__(self, piece: int, offset: int, length: int):
         self.piece = piece
         self.offset = offset
         self.length = length
-        self.status = Block.Missing
-        self.data = None
 
 
 class Piece:
     """
     Torrent are made up of pieces which are made up of blocks. Each piece is of same
     size except for the last piece which might be smaller.
+
+    The status of the blocks is stored in a byte array indexed by block number
+    (offset // REQUEST_SIZE), so finding the next missing block is a single scan in C.
+
+    Block data is written into a single piece buffer as it arrives and is fed to a
+    running SHA-1 in offset order, so the hash is ready as soon as the last block lands.
     """
+    __slots__ = ('index', 'length', 'hash_value', 'num_blocks', 'remaining',
+                 '_status', '_buf', '_hasher', '_hashed_upto')
 
-    def __init__(self, index: int, blocks: List[Block] = None, hash_value=None):
+    def __init__(self, index: int, length: int, hash_value=None):
         self.index = index
-        self.blocks = blocks if blocks else []
+        self.length = length
         self.hash_value = hash_value
+        self.num_blocks = (length + REQUEST_SIZE - 1) // REQUEST_SIZE
+        # Number of blocks which are not yet retrieved
+        self.remaining = self.num_blocks
+        # Status (Block.Missing, Block.Pending or Block.Retrieved) of each block
+        self._status = bytearray(self.num_blocks)
+        # Piece data, attached by the PieceManager when the piece is started or else
+        # allocated when the first block of the piece is received
+        self._buf = None
+        # SHA-1 of the contiguous run of blocks received from the start of the piece
+        self._hasher = _new_sha1()
+        self._hashed_upto = 0
 
     def reset(self) -> None:
         """
         Reset status of all blocks in a piece to missing irrespective of current state
         """
-        for block in self.blocks:
-            block.status = Block.Missing
+        self._status = bytearray(self.num_blocks)
+        self.remaining = self.num_blocks
+        self._hasher = _new_sha1()
+        self._hashed_upto = 0
+
+    def attach(self, buffer) -> None:
+        """
+        Use the given writable buffer (a pooled bytearray or a view of the piece in the
+        output file) for the piece data. It can be larger than the piece
+        """
+        self._buf = buffer
+
+    def release(self) -> Union[bytearray, None]:
+        """
+        Drop the piece data once it has been written to disk, the buffer is returned
+        so that it can be reused by another piece
+        """
+        buffer, self._buf = self._buf, None
+        if isinstance(buffer, memoryview):
+            buffer.release()
+            return None
+        return buffer
 
     def is_complete(self) -> bool:
         """
         Returns if all blocks of piece are downloaded
         """
-        blocks = [block for block in self.blocks if block.status is not Block.Retrieved]
-        return len(blocks) == 0
+        return self.remaining == 0
 
     def next_request(self) -> Union[Block, None]:
         """
         Get the next missing block of the piece
         """
-        missing_block = [block for block in self.blocks if block.status == Block.Missing]
-        if missing_block:
-            missing_block[0].status = Block.Pending
-            return missing_block[0]
-        return None
+        index = self._status.find(Block.Missing)
+        if index == -1:
+            return None
+        self._status[index] = Block.Pending
+        return Block(self.index, index * REQUEST_SIZE, self._block_length(index))
+
+    def _block_length(self, index: int) -> int:
+        """
+        Returns length of the block, only the last block of the piece can be smaller
+        than REQUEST_SIZE
+        """
+        return min(REQUEST_SIZE, self.length - index * REQUEST_SIZE)
 
     def block_received(self, offset: int, data: bytes) -> None:
         """
@@ -219,31 +346,86 @@ class Piece:
         :param offset: Offset of block inside the piece
         :param data: Block data
         """
-        _block = [block for block in self.blocks if block.offset == offset]
-        block = _block[0] if _block else None
+        index, unaligned = divmod(offset, REQUEST_SIZE)
 
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
-            logging.warning("Received a non-existing block {} in piece {}".format(offset, self.index))
+        if unaligned or not 0 <= index < self.num_blocks:
+            logging.warning("Received a non-existing block %d in piece %d", offset, self.index)
+        elif len(data) != self._block_length(index):
+            logging.warning("Received block %d in piece %d with invalid length %d",
+                            offset, self.index, len(data))
+        elif self._status[index] != Block.Retrieved:
+            if self._buf is None:
+                self._buf = bytearray(self.length)
+            self._buf[offset:offset + len(data)] = data
+            self._status[index] = Block.Retrieved
+            self.remaining -= 1
+            self._update_hash()
+
+    def cancel_request(self, offset: int) -> None:
+        """
+        Marks a requested block as missing again, its request will not be answered
+        """
+        index = offset // REQUEST_SIZE
+        if self._status[index] == Block.Pending:
+            self._status[index] = Block.Missing
+
+    def _update_hash(self) -> None:
+        """
+        Feed the blocks following the already hashed part of the piece to the
+        SHA-1, stopping at the first block which is not yet received
+        """
+        view = memoryview(self._buf)
+        index = self._hashed_upto // REQUEST_SIZE
+        while index < self.num_blocks and self._status[index] == Block.Retrieved:
+            end = self._hashed_upto + self._block_length(index)
+            self._hasher.update(view[self._hashed_upto:end])
+            self._hashed_upto = end
+            index += 1
+        view.release()
 
     def is_hash_matching(self) -> bool:
         """
         Returns if the piece hash (SHA-1) is same as the hash received from torrent meta-info
         """
-        piece_hash = sha1(self.data).digest()
-        return self.hash_value == piece_hash
+        return self._hasher.digest() == self.hash_value
 
     @property
-    def data(self) -> bytes:
+    def data(self) -> memoryview:
         """
-        Returns data of the piece by concatenating all block data (sorting blocks
-        in order of their offset)
+        Returns a view of the piece data (no copy is made)
         """
-        piece_data = sorted(self.blocks, key=lambda block: block.offset)
-        piece_data = [piece.data for piece in piece_data]
-        return b''.join(piece_data)
+        return memoryview(self._buf)[:self.length]
+
+
+class BufferPool:
+    """
+    Pool of piece sized buffers. Completed pieces hand their buffer back once written
+    so that the next piece reuses it instead of allocating (and zeroing) a new one.
+
+    At most max_size idle buffers are kept, extra ones are left to the garbage collector.
+    Buffers may be released from the disk thread, deque appends and pops are thread-safe.
+    """
+
+    def __init__(self, buffer_size: int, max_size: int):
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self._buffers = deque()
+
+    def acquire(self) -> bytearray:
+        """
+        Returns an idle buffer, or a new one if there is none. Its content is undefined
+        """
+        try:
+            return self._buffers.pop()
+        except IndexError:
+            return bytearray(self.buffer_size)
+
+    def release(self, buffer: Union[bytearray, None]) -> None:
+        """
+        Gives the buffer back to the pool
+        """
+        if buffer is not None and len(self._buffers) < self.max_size:
+            self._buffers.append(buffer)
 
 
 class PieceManager:
@@ -252,49 +434,83 @@ class PieceManager:
     the connected peers as well as other peers which might have been disconnected.
     """
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, inmemory_buffer: bool = True):
         self.torrent = torrent
+        # Buffer pieces in memory and write each one in a single copy once verified.
+        # When disabled, blocks are written straight into the mapped output file which
+        # saves piece_length bytes per ongoing piece
+        self.inmemory_buffer = inmemory_buffer
         self.peers = {}
-        self.pending_blocks = []
+        # Requested blocks which are not yet received keyed by (piece index, block offset)
+        self.pending_blocks: Dict[Tuple[int, int], PendingRequest] = {}
         self.have_pieces = []
-        self.ongoing_pieces = []
+        self.ongoing_pieces: Dict[int, Piece] = {}
+        # Called once every piece is verified and written to disk
+        self.on_complete = None
+        # Event loop the disk thread hands the written pieces back to
+        self._loop = None
         self.total_pieces = len(torrent.pieces)
-        self.max_pending_time = 300 * 1000  # 5 minutes
+        self.max_pending_time = 300 * 1_000_000_000  # 5 minutes, in nanoseconds
         self.fd = os.open(self.torrent.output_file, os.O_RDWR | os.O_CREAT)
-        self.missing_pieces = self._init_pieces()
+        # Size of the data left in the output file by a previous run
+        existing_size = os.fstat(self.fd).st_size
+        os.ftruncate(self.fd, self.torrent.total_length)
+        if hasattr(os, 'posix_fallocate'):
+            # Reserve the disk blocks upfront so that writing a piece never has to
+            # allocate file extents, and a full disk fails here instead of with a
+            # SIGBUS on the mapping
+            try:
+                os.posix_fallocate(self.fd, 0, self.torrent.total_length)
+            except OSError as e:
+                # Only the file systems which cannot preallocate are tolerated
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    os.close(self.fd)
+                    raise
+                logging.warning("Unable to preallocate %s: %s", self.torrent.output_file, e)
+        # The mapping is only used to read pieces back when rechecking and to receive
+        # blocks directly when pieces are not buffered in memory. Buffered pieces are
+        # written with pwrite, a copy into the mapping would run holding the GIL
+        self._mm = mmap.mmap(self.fd, self.torrent.total_length, access=mmap.ACCESS_WRITE)
+        # Pieces are written by a single background thread using os.pwrite, which
+        # releases the GIL while copying, so the event loop keeps running meanwhile.
+        # A single worker keeps the writes in order
+        self._disk_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+        # Completed pieces waiting for the disk thread. A single flush job is scheduled
+        # at a time and writes all pieces queued until it runs out of them, so pieces
+        # completing together are sorted and adjacent ones go out in one pwritev call
+        self._pending_writes: List[Piece] = []
+        self._write_lock = threading.Lock()
+        self._flush_scheduled = False
+        # Buffers of the pieces downloaded in memory, a connection rarely works on
+        # more than a couple of pieces at once
+        self._buffers = BufferPool(self.torrent.piece_length, max_size=2 * MAX_PEER_CONNECTIONS)
+        self.missing_pieces: Dict[int, Piece] = {piece.index: piece for piece in self._init_pieces()}
+        # One byte per piece, 1 if the piece is missing. Same layout as the peer bitfields
+        self._missing_mask = bytearray(b'\x01' * self.total_pieces)
+        # Number of connected peers having each piece
+        self.piece_peer_count = array('I', [0] * self.total_pieces)
+        # Min-heap of (peer count, piece index) for the missing pieces. Entries are
+        # never updated in place, a new one is pushed whenever a count changes and
+        # the outdated ones are skipped when popped
+        self._rarity_heap = [(0, index) for index in range(self.total_pieces)]
+        if existing_size:
+            self._recheck(existing_size)
 
     def _init_pieces(self) -> List[Piece]:
         """
         Creates the list of pieces to be downloaded from the peers
         """
-        pieces = []
-        # Number of blocks in a piece if piece if of REQUEST_SIZE
-        num_std_blocks = math.ceil(self.torrent.piece_length / REQUEST_SIZE)
-
-        for piece_index, piece_hash in enumerate(self.torrent.pieces):
-            if piece_index < (self.total_pieces - 1):
-                blocks = [
-                    Block(piece_index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                    for offset in range(num_std_blocks)
-                ]
-            else:
-                # Last piece length maybe small than previous ones
-                last_piece_length = self.torrent.total_length % self.torrent.piece_length
-                # Number of blocks in the last piece
-                num_last_blocks = math.ceil(last_piece_length / REQUEST_SIZE)
-                blocks = [
-                    Block(piece_index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                    for offset in range(num_last_blocks)
-                ]
-
-                # Update last block length in case it is smaller than the REQUEST_SIZE
-                last_block_length = last_piece_length % REQUEST_SIZE
-                if last_block_length > 0:
-                    last_block = blocks[-1]
-                    last_block.length = last_block_length
-                    blocks[-1] = last_block
-            pieces.append(Piece(piece_index, blocks, piece_hash))
-        return pieces
+        piece_length = self.torrent.piece_length
+        last_index = self.total_pieces - 1
+        # Last piece length maybe small than previous ones
+        last_piece_length = self.torrent.total_length - piece_length * last_index
+
+        # Piece hashes are compared with the SHA-1 digest of the piece, both must be
+        # plain 20 bytes objects for the comparison to be a single memcmp
+        return [
+            Piece(index, piece_length if index < last_index else last_piece_length, bytes(piece_hash))
+            for index, piece_hash in enumerate(self.torrent.pieces)
+        ]
 
     @property
     def complete(self) -> bool:
@@ -319,167 +535,416 @@ class PieceManager:
 
     def close(self) -> None:
         """
-        Closes file descriptors opened by PieceManager
-        """
+        Closes file descriptors opened by PieceManager, after waiting for the
+        pending piece writes to finish
+        """
+        self._disk_pool.shutdown(wait=True)
+        # Pieces still downloading may hold views of the mapping which must be
+        # released before it can be closed
+        for piece in self.ongoing_pieces.values():
+            piece.release()
+        if self._mm:
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
         if self.fd:
             os.close(self.fd)
+            self.fd = None
+
+    def _recheck(self, size: int) -> None:
+        """
+        Verifies the pieces already present in the output file and marks the ones
+        matching their hash as downloaded, so an interrupted download resumes where
+        it stopped. SHA-1 releases the GIL, the pieces are hashed by a thread pool
+        """
+        pieces = [piece for piece in self.missing_pieces.values()
+                  if self.torrent.piece_length * piece.index + piece.length <= size]
+        with ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='recheck') as pool:
+            matching = list(pool.map(self._is_written, pieces))
+
+        for piece, is_written in zip(pieces, matching):
+            if is_written:
+                del self.missing_pieces[piece.index]
+                self._missing_mask[piece.index] = 0
+                self.have_pieces.append(piece)
+        logging.info("%d / %d pieces already downloaded in %s",
+                     len(self.have_pieces), self.total_pieces, self.torrent.output_file)
+
+    def _is_written(self, piece: Piece) -> bool:
+        """
+        Returns if the data of the piece in the output file matches the piece hash
+        """
+        pos = self.torrent.piece_length * piece.index
+        with memoryview(self._mm) as view, view[pos:pos + piece.length] as data:
+            return _new_sha1(data).digest() == piece.hash_value
 
     def add_peer(self, peer_id, bitfield):
         """
-        Adds a peer with bitfield representing the pieces available with that peer
+        Adds a peer with bitfield representing the pieces available with that peer.
+
+        The bitfield is stored unpacked, one byte per piece, so checking a piece is a
+        plain index and intersections can be computed on the whole array at once
         """
-        self.peers[peer_id] = bitfield
+        self.remove_peer(peer_id)
+        has = b''.join([_BITFIELD_BYTES[byte] for byte in bitfield.tobytes()])[:self.total_pieces]
+        has = bytearray(has.ljust(self.total_pieces, b'\x00'))
+        self.peers[peer_id] = has
+        index = has.find(1)
+        while index != -1:
+            self._update_piece_count(index, 1)
+            index = has.find(1, index + 1)
 
     def update_peer(self, peer_id, index: int):
         """
         Updates piece availability of the piece
         """
-        if peer_id in self.peers:
-            self.peers[peer_id][index] = 1
+        has = self.peers.get(peer_id)
+        if has is not None and index < self.total_pieces and not has[index]:
+            has[index] = 1
+            self._update_piece_count(index, 1)
 
     def remove_peer(self, peer_id):
         if peer_id in self.peers:
-            del self.peers[peer_id]
+            has = self.peers.pop(peer_id)
+            index = has.find(1)
+            while index != -1:
+                self._update_piece_count(index, -1)
+                index = has.find(1, index + 1)
+
+    def _update_piece_count(self, index: int, delta: int) -> None:
+        """
+        Updates the number of peers having the piece and its position in the rarity heap
+        """
+        self.piece_peer_count[index] += delta
+        if index in self.missing_pieces:
+            heapq.heappush(self._rarity_heap, (self.piece_peer_count[index], index))
+            # Outdated entries are only dropped when they reach the top, rebuild the heap
+            # once they outnumber the valid ones so that it stays bounded
+            if len(self._rarity_heap) > 2 * len(self.missing_pieces) + RARITY_SCAN_LIMIT:
+                self._rarity_heap = [(self.piece_peer_count[i], i) for i in self.missing_pieces]
+                heapq.heapify(self._rarity_heap)
+
+    def _is_outdated(self, entry: Tuple[int, int]) -> bool:
+        """
+        Returns if a rarity heap entry is outdated, its piece is not missing anymore
+        or its peer count has changed since it was pushed
+        """
+        count, index = entry
+        return index not in self.missing_pieces or count != self.piece_peer_count[index]
 
-    def block_received(self, peer_id, piece_index, block_offset, data):
+    def cancel_requests(self, peer_id) -> None:
+        """
+        Forgets the requests sent to a peer which will not be answered, because the
+        peer choked us or the connection is gone. The blocks which are not requested
+        from any other peer become missing again so that other peers can request them
+        right away instead of waiting for the requests to expire
+        """
+        for key, request in list(self.pending_blocks.items()):
+            request.peers.discard(peer_id)
+            if not request.peers:
+                del self.pending_blocks[key]
+                piece = self.ongoing_pieces.get(request.block.piece)
+                if piece:
+                    piece.cancel_request(request.block.offset)
+
+    def block_received(self, peer_id, piece_index, block_offset, data) -> Set:
         """
         Callback function called when a block is received.
 
         After receiving a block, it checks if the piece is complete. If yes,
-        its hash is verified and the piece is written to disk and is added to
-        have_pieces list. If hash is not verified, the piece is reset for re-download
+        its hash is verified and the piece is written to disk and, once written, is
+        added to have_pieces list. If hash is not verified, the piece is reset for re-download
+        :return: The other peers the block is still requested from, in endgame
         """
-        logging.info('Received block {block_offset} for piece {piece_index} '
-                     'from peer {peer_id}: '.format(block_offset=block_offset,
-                                                    piece_index=piece_index,
-                                                    peer_id=peer_id))
+        # Lazy %-formatting, the message is only built when the log level lets it through
+        logging.info('Received block %d for piece %d from peer %s: ',
+                     block_offset, piece_index, peer_id)
 
         # Remove the block from pending blocks
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-                    request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
+        request = self.pending_blocks.pop((piece_index, block_offset), None)
+        duplicates = request.peers - {peer_id} if request else set()
 
-        piece = [piece for piece in self.ongoing_pieces if piece.index == piece_index]
-        piece = piece[0] if piece else None
+        piece = self.ongoing_pieces.get(piece_index)
 
         if piece:
             piece.block_received(block_offset, data)
             if piece.is_complete():
                 if piece.is_hash_matching():
-                    self._write(piece)
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-
-                    total_complete = self.total_pieces - len(self.ongoing_pieces) - len(self.missing_pieces)
-                    logging.info(
-                        '\n................................................................\n'
-                        '{complete} / {total} pieces downloaded {per:.3f}%\n'
-                        '................................................................\n'
-                            .format(complete=total_complete,
-                                    total=self.total_pieces,
-                                    per=(total_complete / self.total_pieces) * 100))
+                    del self.ongoing_pieces[piece.index]
+                    if self.inmemory_buffer:
+                        # Only counted as downloaded once the disk thread has written it
+                        self._queue_write(piece)
+                    else:
+                        # Already in the mapped file, the OS writes the pages back
+                        piece.release()
+                        self._piece_done(piece)
                 else:
-                    logging.warning('Discarding corrupt piece {index}'
-                                    .format(index=piece.index))
+                    logging.warning('Discarding corrupt piece %d', piece.index)
                     piece.reset()
         else:
-            logging.warning('Trying to update a piece which is not ongoing!')
+            # Usually a late endgame copy of a block already retrieved
+            logging.debug('Trying to update a piece which is not ongoing!')
+        return duplicates
+
+    def _piece_done(self, piece: Piece) -> None:
+        """
+        Counts a verified piece, which is stored in the output file, as downloaded
+        """
+        self.have_pieces.append(piece)
+
+        total_complete = len(self.have_pieces)
+        logging.info(
+            '\n................................................................\n'
+            '%d / %d pieces downloaded %.3f%%\n'
+            '................................................................\n',
+            total_complete, self.total_pieces, (total_complete / self.total_pieces) * 100)
+        if self.complete and self.on_complete:
+            self.on_complete()
+
+    def _pieces_written(self, pieces: List[Piece], error: Union[Exception, None]) -> None:
+        """
+        Called on the event loop by the disk thread once it tried to write the pieces.
+        Pieces which could not be written are downloaded again
+        """
+        if error is None:
+            for piece in pieces:
+                self._piece_done(piece)
+            return
+
+        logging.error("Unable to write pieces %s to disk: %s", [piece.index for piece in pieces], error)
+        for piece in pieces:
+            piece.reset()
+            self.missing_pieces[piece.index] = piece
+            self._missing_mask[piece.index] = 1
+            heapq.heappush(self._rarity_heap, (self.piece_peer_count[piece.index], piece.index))
 
-    def next_request(self, peer_id) -> Union[Block, None]:
+    def next_request(self, peer_id, count: int = 1) -> List[Block]:
         """
-        Returns the block that is to be requested next for that peer.
+        Returns up to count blocks that are to be requested next for that peer.
         1. Check if any expired block requests are present
         2. Get the next block from ongoing piece of that peer
         3. Get rarest piece the peer has and return its 1st missing block
         4. Get the next missing piece for the peer
+        5. In endgame, request the blocks pending with other peers
         """
         if peer_id not in self.peers:
-            return None
+            return []
+
+        # Monotonic clock as an integer of nanoseconds, immune to wall-clock adjustments
+        current_time = time.monotonic_ns()
 
-        block = self._expired_requests(peer_id)
-        if not block:
+        blocks = self._expired_requests(peer_id, current_time, count)
+        while len(blocks) < count:
             block = self._next_ongoing(peer_id)
             if not block:
                 piece = self._get_rarest_piece(peer_id)
-                if piece:
-                    return piece.next_request()
-                block = self._next_missing(peer_id)
-        return block
+                block = piece.next_request() if piece else None
+            if not block:
+                break
+            self.pending_blocks[(block.piece, block.offset)] = PendingRequest(
+                block=block, added=current_time, peers={peer_id})
+            blocks.append(block)
+
+        if len(blocks) < count and not self.missing_pieces:
+            blocks += self._endgame_requests(peer_id, count - len(blocks))
+        return blocks
 
-    def _expired_requests(self, peer_id) -> Union[Block, None]:
+    def _expired_requests(self, peer_id, current_time: int, count: int) -> List[Block]:
         """
         Go through the previously requested blocks and check if any request
-        is pending since a long time (> max_pending_time). If yes, return that block
+        is pending since a long time (> max_pending_time). If yes, return up to
+        count of those blocks
         """
-        current_time = int(round(time.time() * 1000))
-
-        for request in self.pending_blocks:
+        blocks = []
+        for request in self.pending_blocks.values():
+            if len(blocks) == count:
+                break
             if self.peers[peer_id][request.block.piece]:
                 if current_time > (request.added + self.max_pending_time):
-                    logging.info('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                        block=request.block.offset,
-                        piece=request.block.piece))
+                    logging.info('Re-requesting block %d for piece %d',
+                                 request.block.offset, request.block.piece)
 
                     request.added = current_time
-                    return request.block
-        return None
+                    request.peers.add(peer_id)
+                    blocks.append(request.block)
+        return blocks
+
+    def _endgame_requests(self, peer_id, count: int) -> List[Block]:
+        """
+        Endgame: every remaining block has already been requested, so the download
+        only waits for the slowest peers. Request the pending blocks from this peer
+        as well, the first copy received is kept and the later ones are ignored
+        """
+        blocks = []
+        for request in self.pending_blocks.values():
+            if len(blocks) == count:
+                break
+            if peer_id not in request.peers and self.peers[peer_id][request.block.piece]:
+                request.peers.add(peer_id)
+                blocks.append(request.block)
+        return blocks
 
     def _next_ongoing(self, peer_id) -> Union[Block, None]:
         """
         Go through the currently ongoing piece for the peer and return
         the next block for that piece
         """
-        for piece in self.ongoing_pieces:
+        for piece in self.ongoing_pieces.values():
             if self.peers[peer_id][piece.index]:
                 block = piece.next_request()
                 if block:
-                    current_time = int(round(time.time() * 1000))
-                    self.pending_blocks.append(PendingRequest(block=block, added=current_time))
-                return block
+                    return block
         return None
 
-    def _get_rarest_piece(self, peer_id) -> Piece:
+    def _get_rarest_piece(self, peer_id) -> Union[Piece, None]:
         """
-        Go through all the missing pieces and check which is the piece that is rarest.
-        If found, return that piece.
+        Walk the rarity heap from the rarest missing piece and return the first one the
+        peer has. The heap is read in order without being modified, and at most
+        RARITY_SCAN_LIMIT entries are inspected. A peer which only has common pieces
+        gets the rarest of the missing pieces it has instead.
         This request strategy is good for keeping the seeder healthy.
         """
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
-                continue
-
-            for peer in self.peers:
-                if self.peers[peer][piece.index]:
-                    piece_count[piece] += 1
-
-        if len(piece_count) == 0:
+        has = self.peers[peer_id]
+        # Both byte arrays hold a byte per piece, a single bitwise AND of them read as
+        # integers gives the missing pieces the peer has
+        common = int.from_bytes(has, 'little') & int.from_bytes(self._missing_mask, 'little')
+        if not common:
             return None
 
-        rarest_piece = min(piece_count, key=lambda piece: piece_count[piece])
-        self.missing_pieces.remove(rarest_piece)
-        self.ongoing_pieces.append(rarest_piece)
-        return rarest_piece
+        heap = self._rarity_heap
+        # Drop the outdated entries on top, each of them was pushed once
+        while heap and self._is_outdated(heap[0]):
+            heapq.heappop(heap)
+
+        # Heap positions to visit, ordered by their entry. The children of an entry are
+        # never smaller than the entry, so the entries are visited in sorted order
+        frontier = [(heap[0], 0)] if heap else []
+        floor = 0
+        for _ in range(RARITY_SCAN_LIMIT):
+            if not frontier:
+                break
+            entry, position = heapq.heappop(frontier)
+            if has[entry[1]] and not self._is_outdated(entry):
+                return self._start_piece(entry[1])
+            floor = entry[0]
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+        # No missing piece is rarer than the last entry inspected, so a piece as rare as
+        # it ends the search early
+        common = common.to_bytes(len(has), 'little')
+        counts = self.piece_peer_count
+        rarest = index = common.find(1)
+        while counts[rarest] > floor:
+            index = common.find(1, index + 1)
+            if index == -1:
+                break
+            if counts[index] < counts[rarest]:
+                rarest = index
+        return self._start_piece(rarest)
 
-    def _write(self, piece):
+    def _queue_write(self, piece: Piece) -> None:
         """
-        Write the piece data to the disk
+        Queue the piece to be written to the disk, scheduling a flush on the disk
+        thread unless one is already running
         """
-        logging.info("Writing piece {0} to disk....".format(piece.index))
-        pos = self.torrent.piece_length * piece.index
-        os.lseek(self.fd, pos, os.SEEK_SET)
-        os.write(self.fd, piece.data)
+        self._loop = asyncio.get_event_loop()
+        with self._write_lock:
+            self._pending_writes.append(piece)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._disk_pool.submit(self._flush_writes)
 
-    def _next_missing(self, peer_id) -> Union[Block, None]:
-        for index, piece in enumerate(self.missing_pieces):
-            if self.peers[peer_id][piece.index]:
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
-                return piece.next_request()
-        return None
+    def _flush_writes(self) -> None:
+        """
+        Runs on the disk thread, writes the queued pieces in order of their position
+        in the file until the queue is empty
+        """
+        while True:
+            with self._write_lock:
+                pieces, self._pending_writes = self._pending_writes, []
+                if not pieces:
+                    self._flush_scheduled = False
+                    return
+            pieces.sort(key=lambda piece: piece.index)
+            run = []
+            for piece in pieces:
+                if run and (piece.index != run[-1].index + 1 or len(run) == WRITE_RUN_LIMIT):
+                    self._write_run(run)
+                    run = []
+                run.append(piece)
+            self._write_run(run)
+
+    def _write_run(self, pieces: List[Piece]) -> None:
+        """
+        Runs on the disk thread, writes pieces with consecutive indices and gives their
+        buffers back to the pool
+        """
+        error = None
+        try:
+            self._write(pieces)
+        except Exception as e:
+            error = e
+        for piece in pieces:
+            self._buffers.release(piece.release())
+        self._hand_back(pieces, error)
+
+    def _hand_back(self, pieces: List[Piece], error: Union[Exception, None]) -> None:
+        """
+        Runs on the disk thread, reports the outcome of writing the pieces to the
+        event loop
+        """
+        try:
+            self._loop.call_soon_threadsafe(self._pieces_written, pieces, error)
+        except RuntimeError:
+            # The loop is closed, the download was stopped. Pieces written are found
+            # again by the recheck of the next run
+            if error is not None:
+                logging.error("Unable to write pieces %s to disk: %s", [piece.index for piece in pieces], error)
+
+    def _write(self, pieces: List[Piece]) -> None:
+        """
+        Write the data of pieces with consecutive indices to the disk, they are
+        adjacent in the file
+        """
+        logging.info("Writing pieces %d-%d to disk....", pieces[0].index, pieces[-1].index)
+        pos = self.torrent.piece_length * pieces[0].index
+        views = [piece.data for piece in pieces]
+        try:
+            remaining = views
+            if len(views) > 1 and hasattr(os, 'pwritev'):
+                written = os.pwritev(self.fd, views, pos)
+                pos += written
+                # A short write leaves the rest to the per piece path below
+                remaining = []
+                for data in views:
+                    if written < len(data):
+                        remaining.append(data[written:])
+                    written = max(0, written - len(data))
+            for data in remaining:
+                while data:
+                    written = _pwrite(self.fd, data, pos)
+                    data, pos = data[written:], pos + written
+        finally:
+            for data in views:
+                data.release()
+
+    def _start_piece(self, index: int) -> Piece:
+        """
+        Moves the piece from missing to ongoing pieces
+        """
+        piece = self.missing_pieces.pop(index)
+        self._missing_mask[index] = 0
+        if self.inmemory_buffer:
+            piece.attach(self._buffers.acquire())
+        else:
+            pos = self.torrent.piece_length * index
+            with memoryview(self._mm) as view:
+                piece.attach(view[pos:pos + piece.length])
+        self.ongoing_pieces[index] = piece
+        return piece
 
 
 @dataclass()
@@ -487,7 +952,9 @@ class PendingRequest:
     """
     A class representing a request made to peer
     block: Holds block object of the request
-    added: Hold the timestamp of the request
+    added: Hold the monotonic timestamp (ns) of the request
+    peers: Holds the ids of the peers the block was requested from
     """
     block: Block = field()
     added: int = field()
+    peers: Set = field(default_factory=set)
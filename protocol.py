@@ -26,7 +26,6 @@ SOFTWARE.
 
 import asyncio
 import struct
-from asyncio import Queue
 from concurrent.futures import CancelledError
 
 import bitstring
@@ -34,6 +33,8 @@ import bitstring
 from logger import init_logger, debug_logging_enabled
 
 REQUEST_SIZE = 2 ** 14
+# Number of block requests kept in flight with a peer
+PIPELINE_DEPTH = 5
 logging = init_logger(__name__, testing_mode=debug_logging_enabled)
 
 
@@ -55,14 +56,15 @@ class PeerConnection:
 
     Once the remote peer unchoked us, we can start requesting pieces.
     The PeerConnection will continue to request pieces for as long as there are
-    pieces left to request, or until the remote peer disconnects.
+    pieces left to request, or until the remote peer disconnects. Up to
+    PIPELINE_DEPTH block requests are kept in flight to hide the round trip time.
 
     If the connection with a remote peer drops, the PeerConnection will consume
     the next available peer from off the queue and try to connect to that one
     instead.
     """
 
-    def __init__(self, queue: Queue, info_hash,
+    def __init__(self, queue, info_hash,
                  peer_id, piece_manager, on_block_cb=None):
         """
         Constructs a PeerConnection and add it to the asyncio event-loop.
@@ -70,7 +72,8 @@ class PeerConnection:
         Use `stop` to abort this connection and any subsequent connection
         attempts
 
-        :param queue: The async Queue containing available peers
+        :param queue: The queue containing available peers (tracker Peer tuples), its `get` coroutine
+                      waits until a peer is available
         :param info_hash: The SHA1 hash for the meta-data's info
         :param peer_id: Our peer ID used to to identify ourselves
         :param piece_manager: The manager responsible to determine which pieces
@@ -84,6 +87,8 @@ class PeerConnection:
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.remote_id = None
+        # Number of block requests sent to the peer and not yet answered
+        self.in_flight = 0
         self.writer = None
         self.reader = None
         self.piece_manager = piece_manager
@@ -96,9 +101,11 @@ class PeerConnection:
             self.my_state = []
             self.peer_state = []
             self.remote_id = None
+            self.in_flight = 0
 
             logging.info("Waiting for peer to be assigned")
-            ip, port = await self.queue.get()
+            peer = await self.queue.get()
+            ip, port = peer.host, peer.port
             logging.info('Got assigned peer with: {ip}'.format(ip=ip))
 
             try:
@@ -136,6 +143,10 @@ class PeerConnection:
                             self.peer_state.remove('interested')
                     elif type(message) is Choke:
                         self.my_state.append('choked')
+                        # A choking peer discards all the requests it has not answered,
+                        # give the blocks back so that other peers can request them
+                        self.in_flight = 0
+                        self.piece_manager.cancel_requests(self.remote_id)
                     elif type(message) is Unchoke:
                         if 'choked' in self.my_state:
                             self.my_state.remove('choked')
@@ -147,7 +158,7 @@ class PeerConnection:
                         await asyncio.sleep(1)
                         pass
                     elif type(message) is Piece:
-                        self.my_state.remove('pending_request')
+                        self.in_flight = max(0, self.in_flight - 1)
                         self.on_block_cb(
                             peer_id=self.remote_id,
                             piece_index=message.index,
@@ -160,12 +171,11 @@ class PeerConnection:
                         # TODO Add support for sending data
                         logging.info('Ignoring the received Cancel message.')
 
-                    # Send block request to remote peer if we're interested
+                    # Keep the request pipeline full if we're interested
                     if 'choked' not in self.my_state:
                         if 'interested' in self.my_state:
-                            if 'pending_request' not in self.my_state:
-                                self.my_state.append('pending_request')
-                                await self._request_piece()
+                            if self.in_flight < PIPELINE_DEPTH:
+                                await self._request_pieces()
 
             except ProtocolError as e:
                 logging.exception('Protocol error')
@@ -177,6 +187,12 @@ class PeerConnection:
                 logging.exception('An error occurred')
                 self.cancel()
                 raise e
+            finally:
+                # The requests still in flight will never be answered, and the pieces
+                # of the peer no longer count towards their rarity
+                if self.remote_id is not None:
+                    self.piece_manager.cancel_requests(self.remote_id)
+                    self.piece_manager.remove_peer(self.remote_id)
         # self.cancel()
 
     def cancel(self):
@@ -189,8 +205,6 @@ class PeerConnection:
         if self.writer:
             self.writer.close()
 
-        self.queue.task_done()
-
     def stop(self):
         """
         Stop this connection from the current peer (if a connection exist) and
@@ -203,19 +217,32 @@ class PeerConnection:
         if not self.future.done():
             self.future.cancel()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
-            message = Request(block.piece, block.offset, block.length).encode()
-
-            logging.debug('Requesting block {block} for piece {piece} '
-                          'of {length} bytes from peer {peer}'.format(
-                piece=block.piece,
-                block=block.offset,
-                length=block.length,
-                peer=self.remote_id))
+    def cancel_request(self, index: int, begin: int, length: int) -> None:
+        """
+        Sends the cancel message for a requested block which was received from
+        another peer
+        """
+        if self.writer is None or self.writer.is_closing():
+            return
+        logging.debug('Cancelling block %d for piece %d from peer %s', begin, index, self.remote_id)
+        self.writer.write(Cancel(index, begin, length).encode())
+        self.in_flight = max(0, self.in_flight - 1)
 
-            self.writer.write(message)
+    async def _request_pieces(self):
+        """
+        Request blocks from the remote peer until PIPELINE_DEPTH requests are in flight
+        """
+        blocks = self.piece_manager.next_request(self.remote_id,
+                                                 PIPELINE_DEPTH - self.in_flight)
+        if blocks:
+            for block in blocks:
+                logging.debug('Requesting block %d for piece %d of %d bytes from peer %s',
+                              block.offset, block.piece, block.length, self.remote_id)
+
+            self.writer.write(b''.join(
+                Request(block.piece, block.offset, block.length).encode()
+                for block in blocks))
+            self.in_flight += len(blocks)
             await self.writer.drain()
 
     async def _handshake(self):
@@ -284,14 +311,14 @@ class PeerStreamIterator:
                 if data:
                     self.buffer += data
                     message = self.parse()
-                    logging.debug("Data :: {0}".format(message))
+                    logging.debug("Data :: %s", message)
                     if message:
                         return message
                 else:
                     logging.debug('No data read from stream')
                     if self.buffer:
                         message = self.parse()
-                        logging.debug("Data :: {0}".format(message))
+                        logging.debug("Data :: %s", message)
                         if message:
                             return message
                     raise StopAsyncIteration()
@@ -623,8 +650,7 @@ class Have(PeerMessage):
 
     @classmethod
     def decode(cls, data: bytes):
-        logging.debug('Decoding Have of length: {length}'.format(
-            length=len(data)))
+        logging.debug('Decoding Have of length: %d', len(data))
         index = struct.unpack('>IbI', data)[2]
         return cls(index)
 
@@ -666,8 +692,7 @@ class Request(PeerMessage):
 
     @classmethod
     def decode(cls, data: bytes):
-        logging.debug('Decoding Request of length: {length}'.format(
-            length=len(data)))
+        logging.debug('Decoding Request of length: %d', len(data))
         # Tuple with (message length, id, index, begin, length)
         parts = struct.unpack('>IbIII', data)
         return cls(parts[2], parts[3], parts[4])
@@ -714,8 +739,7 @@ class Piece(PeerMessage):
 
     @classmethod
     def decode(cls, data: bytes):
-        logging.debug('Decoding Piece of length: {length}'.format(
-            length=len(data)))
+        logging.debug('Decoding Piece of length: %d', len(data))
         length = struct.unpack('>I', data[:4])[0]
         parts = struct.unpack('>IbII' + str(length - Piece.length) + 's',
                               data[:length + 4])
@@ -749,8 +773,7 @@ class Cancel(PeerMessage):
 
     @classmethod
     def decode(cls, data: bytes):
-        logging.debug('Decoding Cancel of length: {length}'.format(
-            length=len(data)))
+        logging.debug('Decoding Cancel of length: %d', len(data))
         # Tuple with (message length, id, index, begin, length)
         parts = struct.unpack('>IbIII', data)
         return cls(parts[2], parts[3], parts[4])
@@ -28,6 +28,7 @@ import argparse
 import asyncio
 from collections import namedtuple
 from hashlib import sha1
+from typing import List
 
 import bencodepy
 
@@ -42,6 +43,22 @@ Represents each file within the torrent
 TorrentFile = namedtuple('TorrentFile', ['name', 'length'])
 
 
+def _bencode_end(data: bytes, pos: int) -> int:
+    """
+    Returns the position just after the bencoded value starting at pos
+    """
+    kind = data[pos:pos + 1]
+    if kind == b'i':
+        return data.index(b'e', pos) + 1
+    if kind in (b'l', b'd'):
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            pos = _bencode_end(data, pos)
+        return pos + 1
+    colon = data.index(b':', pos)
+    return colon + 1 + int(data[pos:colon])
+
+
 class Torrent:
     """
     Represents torrent meta-data present in the .torrent file
@@ -51,10 +68,13 @@ class Torrent:
     def __init__(self, torrent_path):
         self.torrent_path = torrent_path
         self.files = []
+        # Piece hashes, split from the meta-info on first access
+        self._pieces = None
         if self._validate_torrent_file():
-            self.meta_info = bencodepy.bread(self.torrent_path)
-            info = bencodepy.encode(self.meta_info[b"info"])
-            self.info_hash = sha1(info).digest()
+            with open(self.torrent_path, 'rb') as f:
+                raw = f.read()
+            self.meta_info = bencodepy.decode(raw)
+            self.info_hash = sha1(self._info_bytes(raw)).digest()
             self._get_torrent_files()
 
     def __str__(self):
@@ -80,6 +100,24 @@ class Torrent:
 
         return True
 
+    @staticmethod
+    def _info_bytes(raw: bytes) -> memoryview:
+        """
+        Returns the bytes of the info dictionary exactly as they appear in the .torrent
+        file. The info hash is defined over these bytes, re-encoding the decoded
+        dictionary only gives the same bytes if the file was encoded canonically
+        """
+        view = memoryview(raw)
+        # Walk the keys of the top level dictionary, skipping their values
+        pos = 1
+        while raw[pos:pos + 1] != b'e':
+            value = _bencode_end(raw, pos)
+            end = _bencode_end(raw, value)
+            if view[pos:value] == b'4:info':
+                return view[value:end]
+            pos = end
+        raise RuntimeError("Torrent meta-info has no info dictionary")
+
     def _get_torrent_files(self):
         """
         Returns the file present in the torrent. Currently it doesn't support torrents containing multiple files
@@ -91,6 +129,7 @@ class Torrent:
             TorrentFile(
                 name=self.meta_info[b"info"][b"name"].decode("utf-8"),
                 length=self.meta_info[b"info"][b"length"]))
+        logging.info("Torrent output file: %s", self.files[0].name)
 
     @property
     def announce(self) -> str:
@@ -99,6 +138,17 @@ class Torrent:
         """
         return self.meta_info[b"announce"].decode("utf-8")
 
+    @property
+    def announce_list(self) -> List[str]:
+        """
+        Returns the HTTP tracker URLs of the torrent, the announce URL followed by the
+        ones of the announce-list (BEP 12) without duplicates. UDP trackers are not supported
+        """
+        urls = [self.announce]
+        for tier in self.meta_info.get(b"announce-list", []):
+            urls.extend(url.decode("utf-8") for url in tier)
+        return [url for url in dict.fromkeys(urls) if url.startswith(("http://", "https://"))]
+
     @property
     def is_multi_file(self) -> bool:
         """
@@ -125,20 +175,20 @@ class Torrent:
     @property
     def pieces(self):
         """
-        Returns a list containing the SHA1 (each 20 bytes long) of all the pieces
+        Returns a list containing the SHA1 (each 20 bytes long) of all the pieces.
+        The list is built once and shared by all callers, it must not be modified
         """
-        data = self.meta_info[b"info"][b"pieces"]
-        pieces, offset, length = [], 0, len(data)
-        pieces = [data[offset: offset + 20] for offset in range(0, length, 20)]
-        return pieces
+        if self._pieces is None:
+            data = self.meta_info[b"info"][b"pieces"]
+            self._pieces = [data[offset: offset + 20] for offset in range(0, len(data), 20)]
+        return self._pieces
 
     @property
     def output_file(self):
         """
         Returns the output filename that we will use to save the torrent data in
         """
-        logging.info("Torrent output file: {0}".format(self.meta_info[b"info"][b"name"].decode("utf-8")))
-        return self.meta_info[b"info"][b"name"].decode("utf-8")
+        return self.files[0].name
 
 
 if __name__ == "__main__":
@@ -147,8 +197,13 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     t = Torrent(torrent_path=args.file)
-    tr = Tracker(t)
+
+
+    async def announce():
+        async with Tracker(t) as tr:
+            return await tr.connect()
+
 
     loop = asyncio.get_event_loop()
-    r1 = loop.run_until_complete(tr.connect())
+    r1 = loop.run_until_complete(announce())
     print(r1)
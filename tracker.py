@@ -24,17 +24,48 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import random
+import asyncio
+import os
 import socket
+import struct
+from collections import namedtuple
+from typing import Optional
 from urllib.parse import urlencode
 
 import aiohttp
-import bencodepy
+from yarl import URL
 
 from logger import init_logger, debug_logging_enabled
 
 logging = init_logger(__name__, testing_mode=debug_logging_enabled)
 
+try:
+    # Optional, Cython implementation of bencode which decodes responses much faster
+    from bencoder import bdecode
+except ImportError:
+    from bencodepy import decode as bdecode
+
+# Maximum number of trackers announced to at once
+MAX_CONCURRENT_ANNOUNCES = 32
+# Seconds after which an announce to an unresponsive tracker is given up
+ANNOUNCE_TIMEOUT = 30
+# Largest tracker response accepted, a compact peer list of ~170k peers
+MAX_RESPONSE_SIZE = 2 ** 20
+# Start of a response whose first key is the failure reason
+_FAILURE_PREFIX = b"d14:failure reason"
+
+
+class Peer(namedtuple('Peer', ['ip', 'port'])):
+    """
+    A peer received from the tracker. The IPv4 address is kept packed (4 bytes in
+    network order) as received and only formatted when connecting to the peer
+    """
+    __slots__ = ()
+
+    @property
+    def host(self) -> str:
+        return socket.inet_ntoa(self.ip)
+
 
 class Tracker:
     """
@@ -44,63 +75,158 @@ class Tracker:
 
     def __init__(self, torrent):
         self.torrent = torrent
-        self.http_client = aiohttp.ClientSession(trust_env=True)
+        # Created on the first announce, a session has to be created inside the event loop
+        self.http_client = None
         self.peer_id = self._calculate_peer_id()
+        # Announce URLs with the request parameters which are the same for every announce,
+        # percent-encoded once. An announce URL may already have a query (e.g. a passkey)
+        static_query = urlencode({
+            'info_hash': self.torrent.info_hash,
+            'peer_id': self.peer_id,
+            'port': 6889,  # try changing this??
+            'compact': 1
+        })
+        self._announce_urls = [
+            f"{url}{'&' if '?' in url else '?'}{static_query}"
+            for url in self.torrent.announce_list or [self.torrent.announce]
+        ]
 
     async def connect(self, first: bool = None, uploaded: int = 0, downloaded: int = 0):
         """
-        Make announcement call to the tracker with the current client torrent stats.
+        Make announcement call to the trackers with the current client torrent stats.
         If successful we will receive a response containing the peer list to connect to
         for downloading torrent data.
         TrackerResponse wraps the received data to be used by client
+
+        All trackers of the torrent are announced to concurrently over the shared session.
+        The first response to arrive is returned right away and the announces still
+        running are cancelled, so a dead tracker does not delay the others
+        """
+        query = self._get_request_query(first, uploaded, downloaded)
+        limit = asyncio.Semaphore(MAX_CONCURRENT_ANNOUNCES)
+        tasks = [asyncio.ensure_future(self._announce(url, query, limit)) for url in self._announce_urls]
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # Every announce failed
+        if len(tasks) > 1:
+            for url, task in zip(self._announce_urls, tasks):
+                error = task.exception()
+                logging.warning("Announce to %s failed: %s", url.split('?', 1)[0], str(error) or type(error).__name__)
+        raise tasks[0].exception()
+
+    async def _announce(self, announce_url: str, query: str, limit: asyncio.Semaphore):
         """
-        params = self._get_request_params(first, uploaded, downloaded)
+        Make the announcement call to a single tracker
+        """
+        # The URL is already percent-encoded, aiohttp must not parse and requote it
+        tracker_url = URL(f"{announce_url}&{query}", encoded=True)
 
-        tracker_url = self.torrent.announce + '?' + urlencode(params)
-        logging.info(f"Connecting to tracker at:: {tracker_url} ")
+        async with limit:
+            logging.info("Connecting to tracker at:: %s ", tracker_url)
+            return await self._get(tracker_url)
 
-        async with self.http_client.get(tracker_url) as response:
+    async def _get(self, tracker_url: URL):
+        """
+        Sends the announce request and wraps the tracker response
+        """
+        async with self._session().get(tracker_url) as response:
             if not response.status == 200:
                 raise ConnectionError(f"Unable to connect to tracker: status code {response.status}")
-            tracker_response = await response.read()
+            tracker_response = await self._read_response(response)
             self.check_for_error(tracker_response)
-            return TrackerResponse(bencodepy.decode(tracker_response))
+            tracker_response = TrackerResponse(bdecode(tracker_response))
+            if tracker_response.failure:
+                raise ConnectionError(f"Unable to connect to tracker: {tracker_response.failure}")
+            return tracker_response
 
-    def _calculate_peer_id(self):
+    @staticmethod
+    async def _read_response(response) -> bytes:
+        """
+        Reads the response body in chunks, giving up as soon as it grows past
+        MAX_RESPONSE_SIZE instead of buffering whatever the tracker sends
+        """
+        if (response.content_length or 0) > MAX_RESPONSE_SIZE:
+            raise ConnectionError(f"Tracker response too large: {response.content_length} bytes")
+
+        chunks, size = [], 0
+        async for chunk in response.content.iter_chunked(2 ** 16):
+            size += len(chunk)
+            if size > MAX_RESPONSE_SIZE:
+                raise ConnectionError(f"Tracker response too large: more than {MAX_RESPONSE_SIZE} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _calculate_peer_id(self) -> bytes:
         """
         https://wiki.theory.org/BitTorrentSpecification#peer_id
         """
-        return "-EZ1426-" + "".join([str(random.randint(0, 9)) for _ in range(12)])
-
-    def check_for_error(self, tracker_response):
-        try:
-            message = tracker_response.decode("utf-8")
-            if "failure" in message:
-                raise ConnectionError(f"Unable to connect to tracker: {message}")
-        except UnicodeDecodeError:
-            pass
-
-    def close(self):
-        self.http_client.close()
+        # 12 random digits from a single read of the OS random source, which unlike the
+        # random module has no shared state. Kept as bytes, the form in which it is sent
+        # both in the announce query and in the peer handshake
+        return b"-EZ1426-%012d" % (int.from_bytes(os.urandom(8), 'big') % 10 ** 12)
 
-    def _get_request_params(self, first: bool = None, uploaded: int = 0, downloaded: int = 0):
+    def check_for_error(self, tracker_response: bytes):
         """
-        Returns the URL request parameters to be sent to tracker
+        Raises if the tracker answered with nothing but a failure reason (the usual
+        answer of a busy or throttling tracker), without decoding the response.
+        Failures sent along with other keys are found once the response is decoded
         """
-        params = {
-            'info_hash': self.torrent.info_hash,
-            'peer_id': self.peer_id,
-            'uploaded': uploaded,
-            'downloaded': downloaded,
-            'port': 6889,  # try changing this??
-            'left': self.torrent.total_length - downloaded,
-            'compact': 1
-        }
+        if not tracker_response.startswith(_FAILURE_PREFIX):
+            return
+        start = len(_FAILURE_PREFIX)
+        colon = tracker_response.find(b":", start)
+        length = tracker_response[start:colon]
+        if colon != -1 and length.isdigit():
+            message = tracker_response[colon + 1:colon + 1 + int(length)].decode("utf-8", "replace")
+            raise ConnectionError(f"Unable to connect to tracker: {message}")
+
+    def _session(self) -> aiohttp.ClientSession:
+        """
+        Returns the HTTP session, creating it on first use. A single session is reused
+        by all announces so the connection to the tracker (and its TLS session) is kept
+        alive between them and the tracker host is resolved once
+        """
+        if self.http_client is None:
+            self.http_client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=MAX_CONCURRENT_ANNOUNCES, ttl_dns_cache=600,
+                                               keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=ANNOUNCE_TIMEOUT),
+                trust_env=True)
+        return self.http_client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.close()
+            self.http_client = None
+
+    def _get_request_query(self, first: bool = None, uploaded: int = 0, downloaded: int = 0) -> str:
+        """
+        Returns the URL request parameters to be sent to tracker which change between
+        announces, the others are already part of the announce URL. These are all
+        integers (or plain words), they need no percent-encoding
+        """
+        left = self.torrent.total_length - downloaded
+        query = f"uploaded={uploaded}&downloaded={downloaded}&left={left}"
 
         if first:
-            params['event'] = 'started'
+            query += "&event=started"
 
-        return params
+        return query
 
 
 class TrackerResponse:
@@ -109,74 +235,72 @@ class TrackerResponse:
     announce URL
     More info: https://wiki.theory.org/BitTorrentSpecification#Tracker_Response
     """
+    __slots__ = ('tracker_response', 'failure', 'warning', 'interval', 'complete', 'incomplete',
+                 '_peers_blob', '_parse_peers', '_peers')
 
     def __init__(self, tracker_response):
         self.tracker_response = tracker_response
+        # Reason of the failure, the other fields are then missing
+        failure = tracker_response.get(b"failure reason")
+        self.failure: Optional[str] = failure.decode("utf-8") if failure is not None else None
+        # Warning message, the response is otherwise processed normally
+        warning = tracker_response.get(b"warning message")
+        self.warning: Optional[str] = warning.decode("utf-8") if warning is not None else None
+        # The interval in seconds that the client should wait before sending
+        # periodic calls to the tracker
+        self.interval: int = tracker_response.get(b"interval", 0)
+        # Number of peers with complete file i.e seeders
+        self.complete: int = tracker_response.get(b"complete", 0)
+        # Number of non-seeder peers i.e leechers
+        self.incomplete: int = tracker_response.get(b"incomplete", 0)
+        self._peers_blob = tracker_response.get(b"peers", b"")
+        # The peers model is known once the response is decoded, pick its parser now
+        if isinstance(self._peers_blob, list):
+            self._parse_peers = self._parse_dict_peers
+        else:
+            self._parse_peers = self._parse_binary_peers
+        # Decoded peer list, filled on first access
+        self._peers = None
 
     @property
-    def failure(self):
-        if b"failure reason" in self.tracker_response:
-            return self.tracker_response[b"failure reason"].decode("utf-8")
-        return None
-
-    @property
-    def warning(self):
-        if b"warning message" in self.tracker_response:
-            return self.tracker_response[b"warning message"].decode("utf-8")
-        return None
-
-    @property
-    def interval(self) -> int:
-        """
-        The interval in seconds that the client should wait before sending
-        periodic calls to the tracker
-        """
-        return self.tracker_response.get(b"interval", 0)
-
-    @property
-    def complete(self) -> int:
+    def peers(self):
         """
-        Number of peers with complete file i.e seeders
+        A list of Peer tuples each representing a peer (ip, port). The list is decoded
+        once, later accesses (e.g. when logging the response) return the same list
         """
-        return self.tracker_response.get(b"complete", 0)
+        if self._peers is None:
+            self._peers = self._parse_peers()
+        return self._peers
 
-    @property
-    def incomplete(self) -> int:
+    def _parse_dict_peers(self):
         """
-        Number of non-seeder peers i.e leechers
+        Dictionary model, a list of dicts with the ip and port of each peer.
+        Only IPv4 addresses are supported, peers given by hostname or IPv6 are skipped
         """
-        return self.tracker_response.get(b"incomplete", 0)
-
-    @property
-    def peers(self):
+        logging.info("The peers list is a list of dict (dictionary model)")
+        peers = []
+        for peer in self._peers_blob:
+            try:
+                ip = socket.inet_pton(socket.AF_INET, peer[b'ip'].decode())
+                peers.append(Peer(ip, int(peer[b'port'])))
+            except (KeyError, TypeError, ValueError, OSError):
+                logging.debug("Skipping unsupported peer %s", peer)
+        return peers
+
+    def _parse_binary_peers(self):
         """
-        A list of tuples each representing a peer (ip, port)
+        Binary model, the peers packed in a single string
         """
-        peers = self.tracker_response[b"peers"]
-
-        if type(peers) == list:
-            logging.info("The peers list is a list of dict (dictionary model)")
-            raise NotImplementedError("The peers list is a list of dict (dictionary model)")
-        else:
-            # Split the data into 6 bytes, where first 4 bytes indicate the peer ip
-            # and the last 2 bytes is peer's TCP port number
-            logging.info("The peers list is string (binary model)")
-            peers = [
-                peers[i:i + 6]
-                for i in range(0, len(peers), 6)
-            ]
-
-            return [
-                (socket.inet_ntoa(ip[:4]), self._decode_port(ip[4:]))
-                for ip in peers
-            ]
-
-    def _decode_port(self, port):
-        import struct
-        return struct.unpack(">H", port)[0]
+        # Each peer is 6 bytes, where first 4 bytes indicate the peer ip
+        # and the last 2 bytes is peer's TCP port number (big-endian).
+        # A truncated trailing entry is ignored
+        logging.info("The peers list is string (binary model)")
+        peers = self._peers_blob
+        peers = peers[:len(peers) - len(peers) % 6]
+        return [Peer._make(peer) for peer in struct.iter_unpack(">4sH", peers)]
 
     def __str__(self):
         return f"incomplete (leechers): {self.incomplete}\n" \
                f"complete (peers): {self.complete}\n" \
                f"interval (sec): {self.interval}\n" \
-               f"peers ip:port: {self.peers}\n"
+               f"peers ip:port: {[f'{peer.host}:{peer.port}' for peer in self.peers]}\n"